@@ -4,6 +4,9 @@ import argparse
 import importlib.util
 import os
 import re
+import functools
+import collections
+import pickle
 
 # Output DNA matches in a tree view in Graphviz DOT format.
 # Given a GEDCOM with people having a custom event of name as input
@@ -30,10 +33,14 @@ import re
 # add some extra output info and some details to stderr
 DEBUG = False
 
+# location of this program, for finding library modules
+program_dir = os.path.dirname( os.path.realpath( __file__ ) )
+
 # lines to ancestors
-line_colors = ['orchid', 'tomato', 'lightseagreen']
-line_colors.extend( ['chocolate', 'forestgreen', 'darkorange', 'teal'] )
-line_colors.extend( ['yellowgreen', 'coral', 'royalblue', 'salmon'] )
+line_colors = ( 'orchid', 'tomato', 'lightseagreen',
+                'chocolate', 'forestgreen', 'darkorange', 'teal',
+                'yellowgreen', 'coral', 'royalblue', 'salmon' )
+n_line_colors = len( line_colors )
 
 # box containing a match person
 match_color = 'springgreen'
@@ -48,8 +55,25 @@ multi_marr_color = '#ffc000'  #golden yellow
 missing_name = 'unknown'
 
 # I tend to list the wife first, the displar ordering can be changed by
-# swapping the names in this list
-partner_types = [ 'wife', 'husb' ]
+# swapping the names in this tuple
+partner_types = ( 'wife', 'husb' )
+
+# a dna value is a number at the start of the note followed by "cM",
+# such as "62 cM", "1,234 cm", "123.7 cM, a cousin", "+5 cM", "1e3 cM"
+# the lookahead needs a digit in the number, so commas or a dot alone don't match
+dna_cm_pattern = re.compile( r'^\s*([-+]?(?=[0-9,]*\.?,*[0-9])[0-9,]*(?:\.[0-9,]*)?(?:e[-+]?[0-9]+)?)\s+cm(?:$|[\s.,;:])', re.IGNORECASE )
+
+# cousin numbers in relationship names: 1C, 2C, 2C1R, etc.
+cousin_pattern = re.compile( r'^(\d\d*)C' )
+
+# name characters to drop or make safe for DOT/HTML labels
+name_translations = str.maketrans( { '/': None, '&': '&amp;', '"': '&quot;', "'": '&rsquo;' } )
+
+# characters removed from an xref to make a DOT node id
+dot_id_removals = str.maketrans( '', '', '@if.' )
+
+# characters removed from an xref to make a GEDCOM output id
+ged_id_removals = str.maketrans( '', '', '@IiFf' )
 
 
 def get_version():
@@ -71,7 +95,7 @@ def load_my_module( module_name, relative_path ):
     assert isinstance( module_name, str ), 'Non-string passed as module name'
     assert isinstance( relative_path, str ), 'Non-string passed as relative path'
 
-    file_path = os.path.dirname( os.path.realpath( __file__ ) )
+    file_path = program_dir
     file_path += os.path.sep + relative_path
     file_path += os.path.sep + module_name + '.py'
 
@@ -79,6 +103,8 @@ def load_my_module( module_name, relative_path ):
 
     module_spec = importlib.util.spec_from_file_location( module_name, file_path )
     my_module = importlib.util.module_from_spec( module_spec )
+    # registered so that objects from the module can be pickled
+    sys.modules[module_name] = my_module
     module_spec.loader.exec_module( my_module )
 
     return my_module
@@ -110,6 +136,8 @@ def get_program_options():
     results['placetitle'] = placetitles[0]
     results['thick'] = 1
     results['separate'] = False
+    results['cache'] = False
+    results['maxgen'] = 0
 
     arg_help = 'Draw DNA matches.'
     parser = argparse.ArgumentParser( description=arg_help )
@@ -158,6 +186,13 @@ def get_program_options():
     #arg_help = 'Separate cousins by removed count. in the matrix format.'
     #parser.add_argument( '--separate', default=results['separate'], action='store_true', help=arg_help )
 
+    arg_help = 'Maximum number of generations to search back for common ancestors. Default is 0 for no limit.'
+    parser.add_argument( '--maxgen', default=results['maxgen'], type=int, help=arg_help )
+
+    arg_help = 'Save the parsed input in a cache file beside the input to speed up later runs.'
+    arg_help += ' The cache file is loaded with pickle, so only use this where the cache file can be trusted.'
+    parser.add_argument( '--cache', default=results['cache'], action='store_true', help=arg_help )
+
     # maybe this should be changed to have a type which better matched a directory
     arg_help = 'Location of the gedcom library. Default is current directory.'
     parser.add_argument( '--libpath', default=results['libpath'], type=str, help=arg_help )
@@ -175,6 +210,10 @@ def get_program_options():
     results['reverse'] = args.reverse_arrows
     results['relationship'] = args.relationship
     results['shortname'] = args.shortname
+    results['cache'] = args.cache
+    if args.maxgen < 0:
+       parser.error( '--maxgen must be zero (no limit) or more' )
+    results['maxgen'] = args.maxgen
 
     # probably best to set as a constant rather than a user option
     # some info above, where the argument setup is commented out
@@ -212,12 +251,70 @@ def get_program_options():
     return results
 
 
+def read_gedcom( file_name, read_opts, use_cache ):
+    """ Return the parsed gedcom data.
+        If using the cache, the parsed data is re-used from the cache file
+        when neither the input, the library, nor the parse options have changed,
+        otherwise the file is parsed and the cache file is re-written.
+        The cache file holds the key then the data as two pickle records, so that
+        the data is only loaded once the key has matched.
+        The cache is a pickle file, loading it can run code, so it must be trusted.
+    """
+    if not use_cache:
+       return readgedcom.read_file( file_name, read_opts )
+
+    cache_file = file_name + '.cache'
+
+    def file_stamp( f ):
+        info = os.stat( f )
+        return [ info.st_mtime, info.st_size ]
+
+    cache_key = [ get_version(), file_stamp( file_name ), file_stamp( readgedcom.__file__ ) ]
+    cache_key.append( sorted( read_opts.items() ) )
+
+    if os.path.isfile( cache_file ):
+       try:
+          with open( cache_file, 'rb' ) as inf:
+               if pickle.load( inf ) == cache_key:
+                  return pickle.load( inf )
+       except Exception as e:
+          # unpickling a damaged or old style cache can fail in many ways,
+          # it isn't usable in any of them so parse the input again
+          print( 'Ignoring unreadable cache file', cache_file, e, file=sys.stderr )
+
+    result = readgedcom.read_file( file_name, read_opts )
+
+    try:
+       with open( cache_file, 'wb' ) as outf:
+            pickle.dump( cache_key, outf, protocol=pickle.HIGHEST_PROTOCOL )
+            pickle.dump( result, outf, protocol=pickle.HIGHEST_PROTOCOL )
+    except ( OSError, pickle.PicklingError ) as e:
+       print( 'Unable to write cache file', cache_file, e, file=sys.stderr )
+
+    return result
+
+
 def show_items( title, the_list ):
     print( title, file=sys.stderr )
     for item in the_list:
         print( '    ', item, the_list[item], file=sys.stderr )
 
 
+def write_lines( lines ):
+    """ Send a batch of output lines to stdout with a single write
+        rather than a print for each line.
+        The bytes go straight to the binary stream, skipping the text layer,
+        as UTF-8 which matches the CHAR setting in the gedcom output. """
+    if lines:
+       text = '\n'.join( lines ) + '\n'
+       if hasattr( sys.stdout, 'buffer' ):
+          sys.stdout.flush()
+          sys.stdout.buffer.write( text.encode( 'utf-8' ) )
+       else:
+          sys.stdout.write( text )
+
+
+@functools.lru_cache( maxsize=None )
 def find_relation_label( me, them ):
     # return a string of the relationship of "them" to "me"
     # as "grandparent", "1C", "auncle", etc
@@ -228,6 +325,8 @@ def find_relation_label( me, them ):
     # "nibling" = "niece or nephew"
     #
     # Note that the labels used here must be the same as in the dna-range setup.
+    #
+    # Results are cached since many matches share the same generation counts.
 
     result = 'N/A'
 
@@ -307,37 +406,27 @@ def extract_dna_cm( indi, note ):
     """ Return the numeric cM value from the note which is
         a number at the start of the line followed by "cM" or "cm" """
 
-    def string_is_numeric( x ):
-        result = True
-        try:
-           y = float( x )
-        except ValueError:
-           result = False
-        return result
-
-    xref = '@I' + str( data[i_key][indi]['xref'] ) + '@'
-
-    s = note.replace('  ',' ').strip().lower()
-
     result = None
 
-    parts = s.split()
-    if len(parts) > 1:
-       if parts[1].startswith('cm') and (parts[1] == 'cm' or parts[1][2] in [' ','.',',',';',':']):
-          # assume anglo numbers with commas but not euro style "1.234,56"
-          number = parts[0].replace(',','')
-          if string_is_numeric( number ):
-             result = float( number )
-             if result < 0:
-                # but not bothering to check for an upper bound
-                result = None
-                print( xref, 'Ignoring invalid DNA value (below zero):', note, file=sys.stderr )
-             else:
-                result = int( round( result ) )
-          else:
-             print( xref, 'Ignoring unusable DNA value:', note, file=sys.stderr )
+    m = dna_cm_pattern.match( note )
+    if m:
+       # assume anglo numbers with commas but not euro style "1.234,56"
+       result = float( m.group(1).replace(',','') )
+       if result < 0:
+          # but not bothering to check for an upper bound
+          result = None
+          xref = '@I' + str( all_indi[indi]['xref'] ) + '@'
+          print( xref, 'Ignoring invalid DNA value (below zero):', note, file=sys.stderr )
+       elif result == float( 'inf' ):
+          # an exponent or a long run of digits can overflow, which can't be rounded
+          result = None
+          xref = '@I' + str( all_indi[indi]['xref'] ) + '@'
+          print( xref, 'Ignoring invalid DNA value (too large):', note, file=sys.stderr )
        else:
-          print( xref, 'Ignoring unusable DNA value:', note, file=sys.stderr )
+          result = int( round( result ) )
+    elif len( note.split() ) > 1:
+       xref = '@I' + str( all_indi[indi]['xref'] ) + '@'
+       print( xref, 'Ignoring unusable DNA value:', note, file=sys.stderr )
 
     return result
 
@@ -347,8 +436,11 @@ def get_xref( individual ):
     return 'i' + str( individual['xref'] )
 
 
-def get_name( individual ):
-    """ Return the name for the individual in the passed data section. """
+@functools.lru_cache( maxsize=None )
+def get_name( indi ):
+    """ Return the name for the individual with the given id.
+        Cached since a person can be labelled more than once. """
+    individual = all_indi[indi]
     name = individual['name'][0]['value']
     if options['shortname']:
        shortened = ''
@@ -358,7 +450,7 @@ def get_name( individual ):
           shortened += individual['name'][0]['surn']
        if shortened.strip():
           name = shortened.strip()
-    name = name.replace( '/', '' ).replace( '&', '&amp;' ).replace('"','&quot;').replace("'","&rsquo;").strip()
+    name = name.translate( name_translations ).strip()
     # the standard unknown code is not good for svg output
     if '?' in name and '[' in name and ']' in name:
        name = 'unknown'
@@ -369,50 +461,62 @@ def get_name( individual ):
 
 def check_for_dna_event( dna_event, value_key, individual ):
     """ Does the person in data section contain the desired dna event.
+        The event name should be given in lowercase.
         Return the found value. "None" means there is no such event. """
     result = None
     if 'even' in individual:
        for event in individual['even']:
-           if event['type'].lower() == dna_event.lower():
+           event_type = event['type']
+           if event_type == dna_event or event_type.lower() == dna_event:
               if value_key in event:
                  result = event[value_key].strip()
               break
     return result
 
 
-def does_fam_have_match( matches, family ):
-    # Does the family contain a person which is a match
-    result = False
-    for parent in partner_types:
-        if parent in family:
-           if family[parent][0] in matches:
-              result = True
-              break
-    return result
+def find_dna_events( dna_event, value_key ):
+    """ Return the dna event text of everyone who has the event
+        as a dict of [indi] = text, so the values can be parsed in one batch. """
+    results = dict()
+    dna_event = dna_event.lower()
+    for indi, indi_data in all_indi.items():
+        # most people have no events at all
+        if 'even' not in indi_data:
+           continue
+        result = check_for_dna_event( dna_event, value_key, indi_data )
+        if result is not None:
+           results[indi] = result
+    return results
 
 
 def begin_ged():
-    print( '0 HEAD' )
-    print( '1 SOUR draw-dna-matches' )
-    print( '1 GEDC' )
-    print( '2 VERS 5.5.1' )
-    print( '2 FORM LINEAGE-LINKED' )
-    print( '1 CHAR UTF-8' )
-    print( '1 SUBM @SUB1@' )
-    print( '0 @SUB1@ SUBM' )
-    print( '1 NAME draw-dna-matches' )
+    out = []
+    out.append( '0 HEAD' )
+    out.append( '1 SOUR draw-dna-matches' )
+    out.append( '1 GEDC' )
+    out.append( '2 VERS 5.5.1' )
+    out.append( '2 FORM LINEAGE-LINKED' )
+    out.append( '1 CHAR UTF-8' )
+    out.append( '1 SUBM @SUB1@' )
+    out.append( '0 @SUB1@ SUBM' )
+    out.append( '1 NAME draw-dna-matches' )
+    write_lines( out )
 
 def end_ged():
-    print( '0 TRLR' )
+    write_lines( ['0 TRLR'] )
 
 
 def make_ged_id( s ):
-    return s.replace('@','').replace('I','').replace('i','').replace('F','').replace('f','')
+    return s.translate( ged_id_removals )
 
 
 def ged_individuals( families, people ):
     # bare minimum information getting saved
 
+    out = []
+
+    event_name = options['eventname']
+
     def show_event( tag, indi_data ):
         if tag in indi_data:
            best = 0
@@ -420,196 +524,196 @@ def ged_individuals( families, people ):
               if tag in indi_data[readgedcom.BEST_EVENT_KEY]:
                  best = indi_data[readgedcom.BEST_EVENT_KEY][tag]
            if 'date' in indi_data[tag][best]:
-              print( '1', tag.upper() )
-              print( '2 DATE', indi_data[tag][best]['date']['in'] )
+              out.append( '1 ' + tag.upper() )
+              out.append( '2 DATE ' + indi_data[tag][best]['date']['in'] )
 
     def show_family( tag, indi_data ):
         if tag in indi_data:
            for fam in indi_data[tag]:
                if fam in families:
-                  print( '1', tag.upper(), '@F' + make_ged_id(fam) + '@' )
+                  out.append( '1 ' + tag.upper() + ' @F' + make_ged_id(fam) + '@' )
 
-    for indi in people:
-        print( '0 @I' + make_ged_id(indi) + '@ INDI' )
-        print( '1 NAME', data[i_key][indi]['name'][0]['value'] )
-        show_event( 'birt', data[i_key][indi] )
-        show_event( 'deat', data[i_key][indi] )
+    # in id order so that the output is the same from run to run,
+    # the xref values are numbers
+    for indi in sorted( people, key=lambda indi: all_indi[indi]['xref'] ):
+        indi_data = all_indi[indi]
+        out.append( '0 @I' + make_ged_id(indi) + '@ INDI' )
+        out.append( '1 NAME ' + indi_data['name'][0]['value'] )
+        show_event( 'birt', indi_data )
+        show_event( 'deat', indi_data )
 
-        show_family( 'fams', data[i_key][indi] )
-        show_family( 'famc', data[i_key][indi] )
+        show_family( 'fams', indi_data )
+        show_family( 'famc', indi_data )
 
         # and must include the dna data
-        tag = 'even'
-        if tag in data[i_key][indi]:
-           for event in data[i_key][indi][tag]:
-               if 'type' in event and event['type'] == options['eventname']:
-                  if 'note' in event:
-                     print( '1 EVEN' )
-                     print( '2 TYPE', options['eventname'] )
-                     print( '2 NOTE', event['note'] )
+        for event in indi_data.get( 'even', [] ):
+            if event.get( 'type' ) == event_name and 'note' in event:
+               out.append( '1 EVEN' )
+               out.append( '2 TYPE ' + event_name )
+               out.append( '2 NOTE ' + event['note'] )
+
+    write_lines( out )
 
 
 def ged_families( families, people ):
-    already_seen = []
+    out = []
+    # the families are dict keys, so each is seen only once
     for fam in families:
-        if fam in already_seen:
-           continue
-        already_seen.append( fam )
-        print( '0 @F' + make_ged_id(fam) + '@ FAM' )
-        for parent in partner_types:
-            if parent in data[f_key][fam]:
-               # only taking the zero'th person as the parent,
-               # maybe shold check all of them
-               indi = data[f_key][fam][parent][0]
-               print( '1', parent.upper(), '@I' + make_ged_id(indi) + '@')
+        fam_data = all_fam[fam]
+        out.append( '0 @F' + make_ged_id(fam) + '@ FAM' )
+        for parent, indi in fam_roles[fam]:
+            out.append( '1 ' + parent.upper() + ' @I' + make_ged_id(indi) + '@' )
         tag = 'chil'
-        if tag in data[f_key][fam]:
-           for child in data[f_key][fam][tag]:
+        if tag in fam_data:
+           for child in fam_data[tag]:
                if child in people:
-                  print( '1 CHIL @I' + make_ged_id(child) + '@' )
+                  out.append( '1 CHIL @I' + make_ged_id(child) + '@' )
+
+    write_lines( out )
 
 
 def make_dot_id( xref ):
-    return xref.lower().replace('@','').replace('i','').replace('f','').replace('.','')
+    return xref.lower().translate( dot_id_removals )
+
+# the ids are requested for every label and every connection,
+# so compute each one only once
 
+@functools.lru_cache( maxsize=None )
 def make_fam_dot_id( fam ):
     # requires use of readgedcom v1.14.0+
-    return 'f' + make_dot_id( str(data[f_key][fam]['xref']) )
+    return 'f' + make_dot_id( str(all_fam[fam]['xref']) )
 
+@functools.lru_cache( maxsize=None )
 def make_indi_dot_id( indi ):
     # requires use of readgedcom v1.14.0+
-    return 'i' + make_dot_id( str(data[i_key][indi]['xref']) )
+    return 'i' + make_dot_id( str(all_indi[indi]['xref']) )
 
 
 def begin_dot_title( title, title_placement ):
+    """ Return the DOT lines which set the graph title """
+    out = []
     if title:
-       print( 'label="' + title + '";' )
+       out.append( 'label="' + title + '";' )
        # default is t for top
        if 't' in title_placement:
-          print( 'labelloc="t";' )
+          out.append( 'labelloc="t";' )
        if 'b' in title_placement:
-          print( 'labelloc="b";' )
+          out.append( 'labelloc="b";' )
        # default is c for center
        if 'l' in title_placement:
-          print( 'labeljust="l";' )
+          out.append( 'labeljust="l";' )
        elif 'r' in title_placement:
-          print( 'labeljust="r";' )
+          out.append( 'labeljust="r";' )
+    return out
 
 
 def begin_dot( orientation, thickness, title, title_placement ):
     """ Start of the DOT output file """
-    print( 'digraph family {' )
-    print( 'node [shape=plaintext];' )
-    print( 'edge [penwidth=' + str( thickness ) + '];' )
-    print( 'rankdir=' + orientation.upper() + ';' )
-    begin_dot_title( title, title_placement )
+    out = []
+    out.append( 'digraph family {' )
+    out.append( 'node [shape=plaintext];' )
+    out.append( 'edge [penwidth=' + str( thickness ) + '];' )
+    out.append( 'rankdir=' + orientation.upper() + ';' )
+    out.extend( begin_dot_title( title, title_placement ) )
+    write_lines( out )
 
 
 def end_dot():
     """ End of the DOT output file """
-    print( '}' )
+    write_lines( ['}'] )
 
 
 def begin_dot_matrix( start_indi, title, title_placement ):
     # should convert this to a here document
-    start_name = get_name( data[i_key][start_indi] )
-
-    print( 'digraph DNA_matches {' )
-
-    begin_dot_title( title, title_placement )
-
-    print( '  node [' )
-    print( '  style = "setlinewidth(2)",' )
-    print( '  fontsize = 11, height = 1,' )
-    print( '  shape = box, width = 1 ]' )
-    print( '' )
-    print( 'subgraph self {' )
-    print( '  graph [rank = same]' )
-    print( '  edge [style = invis];' )
-    print( '  self_label [' )
-    print( '     label = "' + start_name + '",' )
-    print( '     height = 1,' )
-    print( '     row = top' )
-    print( '  ];' )
-    print( '}' )
+    start_name = get_name( start_indi )
+
+    out = []
+    out.append( 'digraph DNA_matches {' )
+
+    out.extend( begin_dot_title( title, title_placement ) )
+
+    out.append( '  node [' )
+    out.append( '  style = "setlinewidth(2)",' )
+    out.append( '  fontsize = 11, height = 1,' )
+    out.append( '  shape = box, width = 1 ]' )
+    out.append( '' )
+    out.append( 'subgraph self {' )
+    out.append( '  graph [rank = same]' )
+    out.append( '  edge [style = invis];' )
+    out.append( '  self_label [' )
+    out.append( '     label = "' + start_name + '",' )
+    out.append( '     height = 1,' )
+    out.append( '     row = top' )
+    out.append( '  ];' )
+    out.append( '}' )
+    write_lines( out )
 
 def end_dot_matrix():
-    print( '}' )
+    write_lines( ['}'] )
 
 
 def add_matrix( matches, displayed, more_separation, show_relationship ):
     # gather people by relationship
-    relations = dict()
-
-    # regexp for cousin numbers
-    # 1C, 2C, 2C1R, etc.
-    cousin_pattern = re.compile( r'^(\d\d*)C' )
+    relations = collections.defaultdict( list )
 
     immediate_relation_key = 'immediate'
     close_relation_key = 'close'
 
-    def collect_relation( i, relation_name ):
-        if relation_name not in relations:
-           relations[relation_name] = []
-        relations[relation_name].append( i )
+    out = []
 
     def output_relations( graph_name, prev_graph_name, color, relation_type ):
-        print( '' )
+        out.append( '' )
 
         # sort by dna match size
         # the lists are not large so performance is not a concern
-        match_sizes = dict()
+        match_sizes = collections.defaultdict( list )
         for indi in relations[relation_type]:
-            # first part of the note should be the dna cM match count
-            # and it might be a non-integer numberr
-            match_size = float( matches[indi]['note'].split(' ')[0] )
-            # numeric precision is not a concern
-            if match_size not in match_sizes:
-               match_sizes[match_size] = []
-            match_sizes[match_size].append( indi )
+            # the dna cM match count as extracted from the event
+            match_sizes[matches[indi]['cm']].append( indi )
 
         label = relation_type
         # special case
         if label in [immediate_relation_key,close_relation_key]:
            label += '\\nfamily'
 
-        print( ' subgraph', graph_name, '{' )
-        print( '   graph [rank = same]' )
-        print( '   node [color="' + color + '"]' )
-        print( '   edge [style = invis];' )
-        print( '  ', graph_name + '_label [' )
-        print( '      label = "' + label + '",' )
-        print( '      height = 0.5,' )
-        print( '      row = top' )
-        print( '   ];' )
+        out.append( ' subgraph ' + graph_name + ' {' )
+        out.append( '   graph [rank = same]' )
+        out.append( '   node [color="' + color + '"]' )
+        out.append( '   edge [style = invis];' )
+        out.append( '   ' + graph_name + '_label [' )
+        out.append( '      label = "' + label + '",' )
+        out.append( '      height = 0.5,' )
+        out.append( '      row = top' )
+        out.append( '   ];' )
 
         n = 0
         prev_node = graph_name + '_label'
 
-        for match_size in reversed(sorted( match_sizes.keys() )):
+        for match_size in sorted( match_sizes, reverse=True ):
             for indi in match_sizes[match_size]:
+                info = matches[indi]
                 n += 1
                 node_name = graph_name + '_' + str( n )
-                indi_info = get_name( data[i_key][indi] )
-                if show_relationship and 'relation' in matches[indi]:
-                   indi_info += '\\n' + matches[indi]['relation']
-                indi_info += '\\n' + matches[indi]['note']
-                print( '  ', node_name, '[label="' + indi_info + '"]' )
-                print( '  ', prev_node, '->', node_name )
+                indi_info = get_name( indi )
+                if show_relationship and 'relation' in info:
+                   indi_info += '\\n' + info['relation']
+                indi_info += '\\n' + info['note']
+                out.append( '   ' + node_name + ' [label="' + indi_info + '"]' )
+                out.append( '   ' + prev_node + ' -> ' + node_name )
                 prev_node = node_name
 
-        print( ' }' )
-        print( '' )
-        print( prev_graph_name + '_label', '->', graph_name + '_label' )
+        out.append( ' }' )
+        out.append( '' )
+        out.append( prev_graph_name + '_label -> ' + graph_name + '_label' )
 
-    for indi in matches:
+    for indi, info in matches.items():
         # the 'relation' valus is 'sibling', '1C', '2C1R', etc
         # which is how people are going to be grouped
 
-        if 'relation' in matches[indi]:
+        if 'relation' in info:
            displayed.add( indi )
-           # don't bother breaking out the half relations from full relations
-           relation = matches[indi]['relation'].upper().replace( 'HALF-', '' )
+           # upper case and no half relations
+           relation = info['relation-key']
            m = cousin_pattern.match( relation )
            if m:
               cousin = m.group(1)
@@ -617,14 +721,14 @@ def add_matrix( matches, displayed, more_separation, show_relationship ):
               if more_separation:
                  # then care more about the cousin removal count, if there is one
                  relation_key = relation
-              collect_relation( indi, relation_key )
+              relations[relation_key].append( indi )
 
            else:
               # must be a parent or child or auncle or other non-cousin
               relation_key = close_relation_key
               if more_separation and relation.lower() in ['parent','sibling','child']:
                  relation_key = immediate_relation_key
-              collect_relation( indi, relation_key )
+              relations[relation_key].append( indi )
 
 
     n_color = 0
@@ -635,21 +739,23 @@ def add_matrix( matches, displayed, more_separation, show_relationship ):
     # closer than cousins (parent, sibling, aunt/uncle, etc)
     for relation_key in [immediate_relation_key, close_relation_key]:
         if relation_key in relations:
-           n_color = ( n_color + 1 ) % len( line_colors )
+           n_color = ( n_color + 1 ) % n_line_colors
            output_relations( relation_key, prev_graph, line_colors[n_color], relation_key )
            prev_graph = relation_key
 
     # then actual cousins by skipping the close family
     # and lexical sorting by key name so that 1C, 1C1R, 2C1R, 2C3R, 3C are displayed in order
 
-    for relation in sorted(list(relations.keys())):
+    for relation in sorted( relations ):
         if relation not in [immediate_relation_key, close_relation_key]:
            # graph name doesn't alllow names with leading digits
            graph_name = 'g' + relation
-           n_color = ( n_color + 1 ) % len( line_colors )
+           n_color = ( n_color + 1 ) % n_line_colors
            output_relations( graph_name, prev_graph, line_colors[n_color], relation )
            prev_graph = graph_name
 
+    write_lines( out )
+
 
 def dot_labels( matches, fam_to_show, people_to_show, married_multi, fam_names, me_id, show_relationship ):
     """ Output a label for each person who appears in the graphs.
@@ -668,97 +774,91 @@ def dot_labels( matches, fam_to_show, people_to_show, married_multi, fam_names,
         and then all labels everything needs to be HTML.
     """
 
-    def output_label( dot_id, s ):
-        text = '<\n<table cellpadding="3" border="1" cellspacing="0" cellborder="0">\n'
-        text += s
-        text += '</table>>'
-        print( dot_id, '[label=' + text + '];' )
+    out = []
+
+    table_start = '<\n<table cellpadding="3" border="1" cellspacing="0" cellborder="0">\n'
+    table_end = '</table>>'
+
+    def output_label( dot_id, parts ):
+        # the parts are the table rows, joined only once
+        out.append( dot_id + ' [label=' + table_start + ''.join( parts ) + table_end + '];' )
+
+    def person_cell( indi, name, port, box_color ):
+        # the table row for one person, with the match info if a match
+        parts = [ '<tr><td port="', port, '"' ]
+        if indi in matches:
+           parts.extend( [ ' bgcolor="', box_color, '">', name, '<br/>', matches[indi]['note'] ] )
+           if show_relationship and 'relation' in matches[indi]:
+              parts.extend( [ '<br/>', matches[indi]['relation'] ] )
+        else:
+           if box_color:
+              parts.extend( [ ' bgcolor="', box_color, '"' ] )
+           parts.extend( [ '>', name ] )
+        parts.append( '</td></tr>\n' )
+        return ''.join( parts )
 
     def output_family_label( fam ):
         parent_ids = []
-        text = ''
+        parts = []
         add_sep = True
 
+        fam_data = all_fam[fam]
+
         for parent in partner_types:
-            if parent in data[f_key][fam]:
-               parent_id = data[f_key][fam][parent][0]
+            if parent in fam_data:
+               parent_id = fam_data[parent][0]
                parent_ids.append( parent_id )
 
-               name = get_name( data[i_key][parent_id] )
+               name = get_name( parent_id )
 
-               text += '<tr><td port="' + parent[0] + '"'
-               if parent_id in matched:
+               box_color = None
+               if parent_id in matches:
                   box_color = match_color
                   if parent_id == me_id:
                      box_color = me_color
+               if parent_id in married_multi:
+                  box_color = multi_marr_color
 
-                  if parent_id in married_multi:
-                     box_color = multi_marr_color
-
-                  text += ' bgcolor="' + box_color + '">' + name
-                  text += '<br/>' + matches[parent_id]['note']
-                  if show_relationship and 'relation' in matched[parent_id]:
-                     text += '<br/>' + matched[parent_id]['relation']
-               else:
-                  if parent_id in married_multi:
-                     text += ' bgcolor="' + multi_marr_color + '"'
-                  text += '>' + name
-               text += '</td></tr>\n'
+               parts.append( person_cell( parent_id, name, parent[0], box_color ) )
 
             else:
               # put something in for a missing parent record
-              text += '<tr><td>' + missing_name + '</td></tr>\n'
+              parts.append( '<tr><td>' + missing_name + '</td></tr>\n' )
 
             if add_sep:
                add_sep = False
                # "u" for "union"
                # shrink up this section
-               smaller = ' cellpadding="0" cellspacing="0"'
-               text += '<tr><td port="u"' + smaller + '>&amp;</td></tr>\n'
+               parts.append( '<tr><td port="u" cellpadding="0" cellspacing="0">&amp;</td></tr>\n' )
 
         if fam in fam_names:
            # add this relationship name
            relation = fam_names[fam]
            if relation:
-              text += '<tr><td bgcolor="' + me_color + '">' + relation + '</td></tr>\n'
+              parts.append( '<tr><td bgcolor="' + me_color + '">' + relation + '</td></tr>\n' )
 
-        output_label( make_fam_dot_id(fam), text )
+        output_label( make_fam_dot_id(fam), parts )
 
         return parent_ids
 
     def output_indi_label( indi ):
-        name = get_name( data[i_key][indi] )
+        name = get_name( indi )
 
-        text = '<tr><td port="i"'
+        box_color = None
         if indi in matches:
            box_color = match_color
            if indi == me_id:
               box_color = me_color
 
-           text += ' bgcolor="' + box_color + '">' + name
-           text += '<br/>' + matches[indi]['note']
-           if show_relationship and 'relation' in matched[indi]:
-              text += '<br/>' + matches[indi]['relation']
-        else:
-           text += '>' + name
-        text += '</td></tr>\n'
-
-        output_label( make_indi_dot_id(indi), text )
+        output_label( make_indi_dot_id(indi), [ person_cell( indi, name, 'i', box_color ) ] )
 
     # use this to skip matches within families
-    already_fam = set()
     already_indi = set()
 
-    # families first
+    # families first, each is a dict key so only seen once
 
     for fam in fam_to_show:
-        if fam not in already_fam:
-           already_fam.add( fam )
-
-           partners = output_family_label( fam )
-
-           for partner in partners:
-               already_indi.add( partner )
+        already_indi.update( output_family_label( fam ) )
 
     # people who aren't in the families
 
@@ -767,123 +867,136 @@ def dot_labels( matches, fam_to_show, people_to_show, married_multi, fam_names,
            already_indi.add( indi )
            output_indi_label( indi )
 
+    write_lines( out )
+
 
 def dot_connect( families_to_show, people_to_show, do_reverse ):
     """ Output the links from one person/family to the next. """
 
-    def get_family_of_child( indi ):
-        results = []
-        key = 'famc'
-        if key in data[i_key][indi]:
-           results.append( data[i_key][indi][key][0] )
-        return results
-
     # if this many incoming edges (or more), set a color on the edges
     n_to_color = 3
 
     # keep the routes from one family to the next
-    # so that there is each one only once
-    routes = set()
+    # so that there is each one only once,
+    # as routes[target] = { sources }
+    # the number of sources is the number of times a family is targeted,
+    # the sources are dict keys to keep them unique and in order
+    routes = collections.defaultdict( dict )
 
-    # count the number of times a family is targeted
-    fam_count = dict()
+    def add_route( source, target ):
+        routes[target][source] = None
 
-    already_indi = set()
+    # the partners in the families can't be shown independantly
+    already_indi = frozenset( partner for fam in families_to_show for partner in fam_partners[fam] )
 
     # families first
 
     for fam in families_to_show:
         # to the parents (if parent family is shown)
-        for partner in partner_types:
-            if partner in data[f_key][fam]:
-               partner_id = data[f_key][fam][partner][0]
+        for partner, partner_id in fam_roles[fam]:
+            parent_fam = indi_famc[partner_id]
+            if parent_fam in families_to_show:
                source = make_fam_dot_id( fam ) + ':' + partner[0] #:w or :h as post
-               # the partners in that source family can't be shown independantly
-               already_indi.add( partner_id )
-               for parent_fam in get_family_of_child( partner_id ):
-                   if parent_fam in families_to_show:
-                      target = make_fam_dot_id( parent_fam ) + ':u'
-                      routes.add( (source, target) )
-
-                      if target not in fam_count:
-                         fam_count[target] = 0
-                      fam_count[target] += 1
+               add_route( source, make_fam_dot_id( parent_fam ) + ':u' )
 
     # individuals
 
     for indi in people_to_show:
         if indi not in already_indi:
-           source = make_indi_dot_id( indi ) + ':i'
-           for parent_fam in get_family_of_child( indi ):
-               if parent_fam in families_to_show:
-                  target = make_fam_dot_id( parent_fam ) + ':u'
-                  routes.add( (source, target) )
-
-                  if target not in fam_count:
-                     fam_count[target] = 0
-                  fam_count[target] += 1
+           parent_fam = indi_famc[indi]
+           if parent_fam in families_to_show:
+              source = make_indi_dot_id( indi ) + ':i'
+              add_route( source, make_fam_dot_id( parent_fam ) + ':u' )
 
     # output the routes
 
-    n_colors = len( line_colors )
-    c = n_colors + 1
+    c = -1
 
-    # choose a color for family links
-    colors = dict()
-    for route in routes:
-        target = route[1]
-        if target in colors:
-           continue
-        colors[target] = ''
-        # if to a family, test for need of a color change
-        if target in fam_count:
-           if fam_count[target] >= n_to_color:
-              # pick the next color
-              c += 1
-              if c >= n_colors:
-                 c = 0
-              colors[target] = ' [color=' + line_colors[c] + ']'
-
-    for route in routes:
-        source = route[0]
-        target = route[1]
-        if do_reverse:
-           print( target + ' -> ' + source + colors[target] + ';' )
-        else:
-           print( source + ' -> ' + target + colors[target] + ';' )
+    out = []
+    for target, sources in routes.items():
+        # choose a color for family links
+        color = ''
+        if len( sources ) >= n_to_color:
+           # pick the next color
+           c = ( c + 1 ) % n_line_colors
+           color = ' [color=' + line_colors[c] + ']'
+
+        for source in sources:
+            if do_reverse:
+               out.append( target + ' -> ' + source + color + ';' )
+            else:
+               out.append( source + ' -> ' + target + color + ';' )
+
+    write_lines( out )
+
+
+def ancestor_path( link ):
+    """ Return the list of families in a path chain as kept by find_ancestors,
+        from the person to the ancestor. """
+    fams = []
+    while link is not None:
+        fams.append( link[0] )
+        link = link[1]
+    fams.reverse()
+    return fams
 
 
 def find_ancestors( indi, path, ancestors ):
     """ Return the ancestors for the given person.
         As a dict of [ancestor] = { 'fam': family,
-                                    'path': [ families to get to this person ]
+                                    'gen': number of generations to the ancestor,
+                                    'link': path chain to the ancestor
                                   }
-        Length of the path is the number of generations to the ancestor.
-    """
+        A path is kept as a chain of ( family, link to the rest ) so that
+        the ancestors share their common part. Use ancestor_path to get
+        the list of families to get to this person.
 
-    key = 'famc'
-    if key in data[i_key][indi] and data[i_key][indi][key]:
-       fam = data[i_key][indi][key][0]
-
-       new_path = path + [fam]
+        Walked with an explicit stack rather than recursion so that deep trees
+        can't exceed the recursion limit. People are visited in the same order
+        as a depth-first recursion, which decides between equal length paths.
+    """
 
-       for partner in partner_types:
-           if partner in data[f_key][fam]:
-              ancestor = data[f_key][fam][partner][0]
+    # the given path is the start of every chain
+    start_link = None
+    for fam in path:
+        start_link = ( fam, start_link )
+    start_depth = len( path )
+
+    # zero means no limit
+    max_gen = options['maxgen']
+
+    # each entry is ( person, path chain to them, length of the path )
+    to_visit = [ (indi, start_link, start_depth) ]
+
+    while to_visit:
+        person, link, depth = to_visit.pop()
+
+        if depth > start_depth:
+           if person == indi:
+              # broken data where a person is their own ancestor
+              continue
+           # pick the shortest path
+           if person in ancestors and ancestors[person]['gen'] < depth:
+              # and everyone further back was already reached by a shorter path
+              continue
+           # link[0] is the family containing this ancestor
+           ancestors[person] = { 'fam': link[0], 'gen': depth, 'link': link }
+
+        if max_gen and depth >= max_gen:
+           continue
 
-              do_update = True
-              if ancestor in ancestors:
-                 # pick the shortest path
-                 if len(ancestors[ancestor]['path']) < len(new_path):
-                    do_update = False
-              if do_update:
-                 ancestors[ancestor] = { 'fam': fam, 'path':new_path }
+        fam = indi_famc[person]
+        if fam is not None:
+           new_link = ( fam, link )
 
-              find_ancestors( ancestor, path + [fam], ancestors )
+           # reversed so that the first partner comes off the stack first
+           for ancestor in reversed( fam_partners[fam] ):
+               to_visit.append( (ancestor, new_link, depth + 1) )
 
 
-def find_common_ancestor( indi, base_person, base_ancestors ):
+def find_common_ancestor( indi, ancestors, base_person, base_ancestors ):
     """ Return the closest ancestor to the "base person" from "indi" in a dict.
+    Both ancestor lists are as from find_ancestors and are only read.
     An empty result means no match, otherwise:
 
     result['indi'] = the ancestor who is the closest
@@ -899,14 +1012,11 @@ def find_common_ancestor( indi, base_person, base_ancestors ):
 
     result = dict()
 
-    ancestors = dict()
-    find_ancestors( indi, [], ancestors )
-
     if base_person in ancestors:
        # person is a direct descendant
        result['indi'] = base_person
        result['fam'] = ancestors[base_person]['fam'] # fam containing base person
-       result['path'] = ancestors[base_person]['path'] # from descendant to base person
+       result['path'] = ancestor_path( ancestors[base_person]['link'] ) # from descendant to base person
        result['match-fam'] = result['fam'] # same fam as above
        result['match-path'] = [] # base person to base person
 
@@ -916,35 +1026,31 @@ def find_common_ancestor( indi, base_person, base_ancestors ):
        result['fam'] = base_ancestors[indi]['fam'] # fam containing ancestor
        result['path'] = [] # base person to base person
        result['match-fam'] = result['fam'] # same fam as above
-       result['match-path'] = base_ancestors[indi]['path'] # from base person to ancestor
+       result['match-path'] = ancestor_path( base_ancestors[indi]['link'] ) # from base person to ancestor
 
     else:
-       # pick a big number
-       found_len = 1000000
-
-       for ancestor in ancestors:
-           if ancestor in base_ancestors:
-              path_len = len( ancestors[ancestor]['path'] )
-              if path_len == found_len:
-                 # if no closer
-                 # prefer same family over "half" relations with different families
-                 them_fam = ancestors[ancestor]['fam']
-                 base_fam = base_ancestors[ancestor]['fam']
-                 if them_fam == base_fam:
-                    # side effect is that without double checking
-                    # this will toggle batween partners in a matched family
-                    result['indi'] = ancestor
-                    result['fam'] = them_fam
-                    result['path'] = ancestors[ancestor]['path']
-                    result['match-fam'] = base_fam
-                    result['match-path'] = base_ancestors[ancestor]['path']
-              elif path_len < found_len:
-                 found_len = path_len
-                 result['indi'] = ancestor
-                 result['fam'] = ancestors[ancestor]['fam']
-                 result['path'] = ancestors[ancestor]['path']
-                 result['match-fam'] = base_ancestors[ancestor]['fam']
-                 result['match-path'] = base_ancestors[ancestor]['path']
+       # only the ancestors in both lists matter,
+       # kept in the order they were found since that decides ties
+       shared = [ ancestor for ancestor in ancestors if ancestor in base_ancestors ]
+
+       if shared:
+          found_len = min( ancestors[ancestor]['gen'] for ancestor in shared )
+          closest = [ ancestor for ancestor in shared if ancestors[ancestor]['gen'] == found_len ]
+
+          # if more than one at the same distance,
+          # prefer same family over "half" relations with different families
+          # side effect is that without double checking
+          # this will toggle batween partners in a matched family
+          chosen = closest[0]
+          for ancestor in closest:
+              if ancestors[ancestor]['fam'] == base_ancestors[ancestor]['fam']:
+                 chosen = ancestor
+
+          result['indi'] = chosen
+          result['fam'] = ancestors[chosen]['fam']
+          result['path'] = ancestor_path( ancestors[chosen]['link'] )
+          result['match-fam'] = base_ancestors[chosen]['fam']
+          result['match-path'] = ancestor_path( base_ancestors[chosen]['link'] )
 
     return result
 
@@ -957,13 +1063,12 @@ def find_families_of_multiple_marriages( people_to_show, families_to_show ):
     # etc.
     results = dict()
 
+    shown = frozenset( families_to_show )
+
     for indi in people_to_show:
-        key = 'fams'
-        if key in data[i_key][indi]:
-           for_this_person = set()
-           for fam in data[i_key][indi][key]:
-               if fam in families_to_show:
-                  for_this_person.add( fam )
+        # most people are in one family at most
+        if len( indi_fams[indi] ) > 1:
+           for_this_person = shown.intersection( indi_fams[indi] )
            if len(for_this_person) > 1:
               results[indi] = list(for_this_person)
 
@@ -985,39 +1090,66 @@ data_opts['exit-on-missing-individuals'] = True
 data_opts['exit-on-missing-families'] = True
 data_opts['only-birth'] = True
 
-data = readgedcom.read_file( options['infile'], data_opts )
+data = read_gedcom( options['infile'], data_opts, options['cache'] )
+
+# the two sections used everywhere, to skip the outer lookup each time
+all_indi = data[i_key]
+all_fam = data[f_key]
+
+# Flattened views of the family connections, built once
+# for the walks through the tree.
+# indi_famc[indi] = birth family, or None
+# indi_fams[indi] = [ families where the person is a partner ]
+# fam_roles[fam] = ( (partner type, partner), ... ) in the order of partner_types
+# fam_partners[fam] = ( partners in the order of partner_types )
+indi_famc = dict()
+indi_fams = dict()
+fam_roles = dict()
+fam_partners = dict()
+
+for indi, indi_data in all_indi.items():
+    indi_famc[indi] = None
+    if indi_data.get( 'famc' ):
+       indi_famc[indi] = indi_data['famc'][0]
+    indi_fams[indi] = indi_data.get( 'fams', [] )
+
+for fam, fam_data in all_fam.items():
+    # only taking the zero'th person as the partner,
+    # maybe shold check all of them
+    fam_roles[fam] = tuple( (partner, fam_data[partner][0]) for partner in partner_types if partner in fam_data )
+    fam_partners[fam] = tuple( partner_id for partner, partner_id in fam_roles[fam] )
 
 # people who have the dna event
-# matched[indi] = { note: the event text, shared: closest shared ancestor )
+# matched[indi] = { note: the event text, cm: the match value, shared: closest shared ancestor )
 matched = dict()
 
 # the id of the base dna match person
 me = None
 
+# what may follow "me" in the event value of the base person
+me_separators = frozenset( ' .,:' )
+
 # the event not existing is different from no extacted values
-found_event = False
-
-for indi in data[i_key]:
-    result = check_for_dna_event( options['eventname'], options['eventtype'], data[i_key][indi] )
-    if result is not None:
-       found_event = True
-       test_for_me = result.lower()
-       if test_for_me.startswith('me') and (test_for_me == 'me' or test_for_me[2] in [' ', '.', ',', ':']):
-          matched[indi] = dict()
-          matched[indi]['note'] = 'me'
-          me = indi
-       else:
-          value = extract_dna_cm( indi, result )
-          if value is not None:
-             if options['min'] <= value <= options['max']:
-                matched[indi] = dict()
-                matched[indi]['note'] = str(value) + ' cM'
+dna_events = find_dna_events( options['eventname'], options['eventtype'] )
 
-if not found_event:
+if not dna_events:
    event_name = '"' + options['eventname'] + '" / "' + options['eventtype'] + '"'
    print( 'Didn\'t locate anyone with the selected event', event_name, file=sys.stderr )
    sys.exit(1)
 
+for indi, result in dna_events.items():
+    if result[:2].lower() == 'me' and (len(result) == 2 or result[2] in me_separators):
+       matched[indi] = dict()
+       matched[indi]['note'] = 'me'
+       me = indi
+    else:
+       value = extract_dna_cm( indi, result )
+       if value is not None:
+          if options['min'] <= value <= options['max']:
+             matched[indi] = dict()
+             matched[indi]['note'] = str(value) + ' cM'
+             matched[indi]['cm'] = value
+
 if not me:
    print( 'Didn\'t find base person', file=sys.stderr )
    sys.exit(1)
@@ -1030,8 +1162,8 @@ if len(matched) < 2:
 if DEBUG:
    print( '', file=sys.stderr )
    print( 'matches', file=sys.stderr )
-   for indi in matched:
-       show_items( indi, matched[indi] )
+   for indi, info in matched.items():
+       show_items( indi, info )
 
 my_ancestors = dict()
 find_ancestors( me, [], my_ancestors )
@@ -1039,79 +1171,76 @@ find_ancestors( me, [], my_ancestors )
 if DEBUG:
    print( '', file=sys.stderr )
    print( 'my ancestors(base person)', me, file=sys.stderr )
-   for indi in my_ancestors:
-       show_items( indi, my_ancestors[indi] )
+   for indi, info in my_ancestors.items():
+       show_items( indi, { 'fam': info['fam'], 'path': ancestor_path( info['link'] ) } )
 
-for indi in matched:
-    if indi == me:
-       matched[indi]['common'] = None
-    else:
-       matched[indi]['common'] = find_common_ancestor( indi, me, my_ancestors )
+# In one pass over the matches find:
+# - the closest shared ancestor
+# - the relationship name, always compute but the flag is if it should be shown
+# - for display purposes all the families in all the paths,
+#   the value for family will be True if one of the partners is also a dna match
+# - the common ancestor families, to add relationship names for them
+# - the matches who can be displayed
 
-if DEBUG:
-   print( '', file=sys.stderr )
-   print( 'matches, closest ancestor', file=sys.stderr )
-   for indi in matched:
-       if matched[indi]['common']:
-          show_items( indi, matched[indi]['common'] )
+families_to_display = dict()
+common_fams = dict()
+people_to_display = set()
+people_to_display.add( me )
 
-# Add relationship names, always compute but the flag is if it should be shown
+for indi, info in matched.items():
+    if indi == me:
+       info['common'] = None
+       continue
 
-if DEBUG and options['relationship']:
-   print( '', file=sys.stderr )
-   print( 'relationships', file=sys.stderr )
-for indi in matched:
-    if matched[indi]['common']:
-       matched[indi]['relation'] = compute_relation( matched[indi]['common'] )
-       if DEBUG and options['relationship']:
-          print( '   ', indi, matched[indi]['relation'], file=sys.stderr )
+    # each match's ancestors are only needed for this one comparison
+    ancestors = dict()
+    find_ancestors( indi, [], ancestors )
 
-# For display purposes find all the families in all the paths.
-# Value for family will be True if one of the partners is also a dna match.
+    closest = find_common_ancestor( indi, ancestors, me, my_ancestors )
+    info['common'] = closest
+    if not closest:
+       continue
 
-families_to_display = dict()
+    info['relation'] = compute_relation( closest )
+    # the matrix grouping doesn't break out half relations from full relations
+    info['relation-key'] = info['relation'].upper().replace( 'HALF-', '' )
 
-for indi in matched:
-    if matched[indi]['common']:
-       path_fams = [] # used below
-       for key in ['fam','match-fam']:
-           fam = matched[indi]['common'][key]
-           families_to_display[fam] = False
-           path_fams.append( fam )
-       for key in ['path','match-path']:
-           for fam in matched[indi]['common'][key]:
-               families_to_display[fam] = False
-
-       # for half relationships, step to one older generation to ensure
-       # the paths are connected
-       if path_fams[0] != path_fams[1]:
-          common = matched[indi]['common']['indi']
-          key = 'famc'
-          if key in data[i_key][common]:
-             fam = data[i_key][common][key][0]
-             families_to_display[fam] = False
-
-# do the test
+    for key in ['fam','match-fam']:
+        families_to_display[closest[key]] = False
+    for key in ['path','match-path']:
+        for fam in closest[key]:
+            families_to_display[fam] = False
 
-for fam in families_to_display:
-    families_to_display[fam] = does_fam_have_match( matched, data[f_key][fam] )
+    # for half relationships, step to one older generation to ensure
+    # the paths are connected, full relationships don't need this
+    if closest['fam'] != closest['match-fam']:
+       fam = indi_famc[closest['indi']]
+       if fam is not None:
+          families_to_display[fam] = False
 
+    # make plural for both parents in family
+    path_len = len( closest['match-path'] )
+    common_fams[closest['match-fam']] = find_relation_label( path_len, 0 ) + 's'
 
-# Add relationship names for ancestors which are common ancestors
-if DEBUG and options['relationship']:
+    # including those who are matches even don't have their own family
+    people_to_display.add( indi )
+
+if DEBUG:
    print( '', file=sys.stderr )
-   print( 'ancestor relationships', file=sys.stderr )
+   print( 'matches, closest ancestor', file=sys.stderr )
+   for indi, info in matched.items():
+       if info['common']:
+          show_items( indi, info['common'] )
+   if options['relationship']:
+      print( '', file=sys.stderr )
+      print( 'relationships', file=sys.stderr )
+      for indi, info in matched.items():
+          if 'relation' in info:
+             print( '   ', indi, info['relation'], file=sys.stderr )
 
-# Find all the common families
-common_fams = dict()
+# do the test: does the family contain a person which is a match
 
-for indi in matched:
-    if indi != me:
-       ancestor = matched[indi]['common']['indi']
-       fam = matched[indi]['common']['match-fam']
-       path_len = len( matched[indi]['common']['match-path'] )
-       # make plural for both parents in family
-       common_fams[fam] = find_relation_label( path_len, 0 ) + 's'
+families_to_display = { fam: any( partner in matched for partner in fam_partners[fam] ) for fam in families_to_display }
 
 for fam in common_fams:
     # Skip the family if one partner is also a DNA match
@@ -1123,18 +1252,10 @@ if DEBUG:
    print( '', file=sys.stderr )
    show_items( 'families_to_display', families_to_display )
 
-# For display purposes find the people who are in the families in the paths
-# Including those who are matches even don't have their own family
+# For display purposes add the people who are in the families in the paths
 
-people_to_display = set()
-people_to_display.add( me )
-for indi in matched:
-    if matched[indi]['common']:
-       people_to_display.add( indi )
 for fam in families_to_display:
-    for partner in partner_types:
-        if partner in data[f_key][fam]:
-           people_to_display.add( data[f_key][fam][partner][0] )
+    people_to_display.update( fam_partners[fam] )
 
 if DEBUG:
    print( '', file=sys.stderr )
@@ -1179,7 +1300,8 @@ if not_displayed:
       print( '', file=sys.stderr )
    print( 'Matches who are not displayed.', file=sys.stderr )
    print( 'Due to missing birth family or common ancestor above tree top.', file=sys.stderr )
-   name = get_name( data[i_key][indi] ).strip()
-   if not DEBUG:
-      name += ' ' + get_xref( data[i_key][indi] ).strip()
-   print( name, matched[indi]['note'], file=sys.stderr )
+   for indi in not_displayed:
+       name = get_name( indi ).strip()
+       if not DEBUG:
+          name += ' ' + get_xref( all_indi[indi] ).strip()
+       print( name, matched[indi]['note'], file=sys.stderr )